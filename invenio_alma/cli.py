@@ -12,10 +12,12 @@ import sys
 
 # import logging
 from os.path import isfile
+from pathlib import Path
 
 import click
 from click_option_group import optgroup
 from flask.cli import with_appcontext
+from invenio_db import db
 from invenio_records_marc21.records.systemfields import MarcDraftProvider
 from sqlalchemy.orm.exc import StaleDataError
 
@@ -23,7 +25,11 @@ from .utils import (
     AlmaConfig,
     RecordConfig,
     create_record,
+    export_records,
     get_identity_from_user_by_email,
+    get_marc21_records,
+    get_peak_rss,
+    release_memory,
 )
 
 # logging.basicConfig()
@@ -47,29 +53,50 @@ class CSV(click.ParamType):
         return reader
 
 
-def handle_csv(csv_file, alma_config, identity):
-    """Process csv file."""
-    for row in csv_file:
-        if len(row["ac_number"]) == 0:
-            continue
+def handle_row(row, alma_config, identity):
+    """Process a single row of the csv file."""
+    if len(row["ac_number"]) == 0:
+        return
 
-        if "marcid" in row and len(row["marcid"]) > 0:
-            MarcDraftProvider.predefined_pid_value = row["marcid"]
+    if "marcid" in row and len(row["marcid"]) > 0:
+        MarcDraftProvider.predefined_pid_value = row["marcid"]
 
-        try:
-            file_pointer = open(row["filename"], mode="r", encoding="utf-8")
-            record_config = RecordConfig(row["ac_number"], file_pointer)
-        except FileNotFoundError:
-            print(f"FileNotFoundError search_value: {row['ac_number']}")
-            continue
+    try:
+        file_pointer = open(row["filename"], mode="r", encoding="utf-8")
+        record_config = RecordConfig(row["ac_number"], file_pointer)
+    except FileNotFoundError:
+        print(f"FileNotFoundError search_value: {row['ac_number']}")
+        return
+
+    try:
+        record = create_record(alma_config, record_config, identity)
+        print(f"record.id: {record.id}")
+    except StaleDataError:
+        print(f"StaleDataError    search_value: {row['ac_number']}")
+        db.session.rollback()
+    finally:
+        file_pointer.close()
+
+
+def handle_csv(
+    csv_file, alma_config, identity, cleanup_interval=100, report_memory=False
+):
+    """Process csv file.
 
-        try:
-            record = create_record(alma_config, record_config, identity)
-            print(f"record.id: {record.id}")
-        except StaleDataError:
-            print(f"StaleDataError    search_value: {row['ac_number']}")
-        finally:
-            file_pointer.close()
+    Every cleanup_interval rows the objects accumulated by the previous
+    records are released, so long runs use constant memory. The user of the
+    identity is kept in the session, because it is used for every row.
+    """
+    keep = [getattr(identity, "user", None)]
+
+    for index, row in enumerate(csv_file, start=1):
+        handle_row(row, alma_config, identity)
+
+        if cleanup_interval and index % cleanup_interval == 0:
+            release_memory(keep=keep)
+
+    if report_memory:
+        print(f"peak rss: {get_peak_rss()} KiB")
 
 
 def handle_single_import(ac_number, marcid, file_, alma_config, identity):
@@ -109,14 +136,49 @@ def alma():
 @optgroup.option("--marcid", type=click.STRING, default="")
 @optgroup.group("Import by file list")
 @optgroup.option("--csv-file", type=CSV())
+@optgroup.option("--cleanup-interval", type=click.IntRange(min=0), default=100)
+@optgroup.option("--report-memory", is_flag=True, default=False)
 def sru(
-    search_key, domain, institution_code, ac_number, file_, user_email, marcid, csv_file
+    search_key,
+    domain,
+    institution_code,
+    ac_number,
+    file_,
+    user_email,
+    marcid,
+    csv_file,
+    cleanup_interval,
+    report_memory,
 ):
     """Search on the SRU service of alma."""
     alma_config = AlmaConfig(search_key, domain, institution_code)
     identity = get_identity_from_user_by_email(email=user_email)
 
     if csv_file:
-        handle_csv(csv_file, alma_config, identity)
+        handle_csv(
+            csv_file,
+            alma_config,
+            identity,
+            cleanup_interval=cleanup_interval,
+            report_memory=report_memory,
+        )
     else:
         handle_single_import(ac_number, marcid, file_, alma_config, identity)
+
+
+@alma.command()
+@with_appcontext
+@click.option("--output", type=click.Path(dir_okay=False), required=True)
+@click.option("--query", type=click.STRING, default="")
+@click.option("--gzip", "gzip_", is_flag=True, default=False)
+@click.option("--shard-size", type=click.IntRange(min=1), default=None)
+@click.option("--user-email", type=click.STRING, default="alma@tugraz.at")
+def export(output, query, gzip_, shard_size, user_email):
+    """Export the marc21 records as MARCXML collection."""
+    identity = get_identity_from_user_by_email(email=user_email)
+    records = get_marc21_records(identity, query=query)
+
+    for path, number_of_records in export_records(
+        records, Path(output), gzip_=gzip_, shard_size=shard_size
+    ):
+        print(f"exported {number_of_records} records to {path}")
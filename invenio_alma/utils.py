@@ -7,21 +7,34 @@
 
 """Common utils functions."""
 
+import gc
+import gzip
+import sys
+import threading
 import time
 import typing as t
+from collections import OrderedDict
+from concurrent.futures import Future
+from copy import deepcopy
 from dataclasses import dataclass
+from functools import partial
+from itertools import chain, count, islice
 from os.path import basename
+from pathlib import Path
 
 import requests
 from flask_principal import Identity
 from invenio_access import any_user
 from invenio_access.utils import get_identity
 from invenio_accounts import current_accounts
+from invenio_db import db
 from invenio_records_marc21 import current_records_marc21
 from invenio_records_marc21.services.record.metadata import Marc21Metadata
 from invenio_records_marc21.services.services import Marc21RecordFilesService
 from lxml import etree
 
+MARC21_NAMESPACE = "http://www.loc.gov/MARC21/slim"
+
 
 @dataclass(frozen=True)
 class AlmaConfig:
@@ -40,6 +53,70 @@ class RecordConfig:
     file_: t.IO
 
 
+class SRURecordLookup:
+    """Coalesce concurrent SRU lookups and remember recent results.
+
+    Concurrent lookups for the same key share one in-flight request. The
+    parsed results of the last ``maxsize`` successful lookups are kept in a LRU for the
+    duration of the run. Every caller gets its own copy of the record, so the
+    cached result can not be modified by the caller.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        """Construct SRURecordLookup."""
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._in_flight: t.Dict[t.Hashable, Future] = {}
+        self._recent: t.Dict[t.Hashable, etree] = OrderedDict()
+
+    def get(self, key: t.Hashable, fetch: t.Callable[[], etree]) -> etree:
+        """Get the record for key, call fetch only if it is not known yet."""
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return deepcopy(self._recent[key])
+
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_leader:
+            return deepcopy(future.result())
+
+        result = None
+        try:
+            result = fetch()
+            future.set_result(result)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if result is not None:
+                    self._remember(key, result)
+
+        return deepcopy(result)
+
+    def _remember(self, key: t.Hashable, result: etree) -> None:
+        """Add result to the recent results, evict the least recently used."""
+        self._recent[key] = result
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget the recent results."""
+        with self._lock:
+            self._recent.clear()
+
+
+sru_lookup = SRURecordLookup()
+"""Lookup shared by all calls of :func:`get_record`."""
+
+
 def get_identity_from_user_by_email(email: str = None) -> Identity:
     """Get the user specified via email or ID."""
     if email is None:
@@ -58,19 +135,25 @@ def get_identity_from_user_by_email(email: str = None) -> Identity:
     return identity
 
 
-def get_response_from_alma(alma_config: AlmaConfig, search_value: str) -> etree:
-    """Get the record from alma."""
+def get_response_from_alma(
+    alma_config: AlmaConfig, search_value: str, timeout: float = 30
+) -> etree:
+    """Get the record from alma.
+
+    The timeout in seconds prevents a hanging request from blocking all the
+    lookups which wait for it in :class:`SRURecordLookup`.
+    """
     base_url = f"https://{alma_config.domain}/view/sru/{alma_config.institution_code}"
     query = f"query=alma.{alma_config.search_key}={search_value}"
     parameters = f"version=1.2&operation=searchRetrieve&{query}"
     url = f"{base_url}?{parameters}"
 
-    response = requests.get(url)
+    response = requests.get(url, timeout=timeout)
 
     return etree.fromstring(response.text.encode("utf-8"))
 
 
-def get_record(alma_config: AlmaConfig, search_value: str) -> etree:
+def fetch_record(alma_config: AlmaConfig, search_value: str) -> etree:
     """Extract record from the response."""
     alma_response = get_response_from_alma(alma_config, search_value=search_value)
 
@@ -82,7 +165,14 @@ def get_record(alma_config: AlmaConfig, search_value: str) -> etree:
 
     # TODO error handling
 
-    return record
+    # a detached copy, otherwise the whole response would stay alive with it
+    return deepcopy(record)
+
+
+def get_record(alma_config: AlmaConfig, search_value: str) -> etree:
+    """Get the record, identical concurrent lookups share one request."""
+    fetch = partial(fetch_record, alma_config, search_value=search_value)
+    return sru_lookup.get((alma_config, search_value), fetch)
 
 
 def add_file_to_record(
@@ -129,3 +219,166 @@ def create_record(
     time.sleep(0.5)
 
     return service.publish(id_=draft.id, identity=identity)
+
+
+def release_memory(keep: t.Iterable = ()) -> None:
+    """Release the objects which accumulated during the previous records.
+
+    All objects except those in keep are expunged from the session. Objects
+    held across the call, e.g. the user of an identity, have to be passed in
+    keep, otherwise they are detached and raise DetachedInstanceError on the
+    next access of an expired attribute. Expunging would silently discard
+    pending changes, therefore the session is left untouched if it has any.
+    """
+    session = db.session
+    if not (session.new or session.dirty or session.deleted):
+        keep = {id(obj) for obj in keep}
+        for obj in list(session):
+            if id(obj) not in keep:
+                session.expunge(obj)
+
+    gc.collect()
+
+
+def get_peak_rss() -> int:
+    """Get the peak resident set size of the process in KiB."""
+    # resource is only available on posix, don't break the import elsewhere
+    import resource  # pylint: disable=import-outside-toplevel
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macos reports bytes, linux kilobytes
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+
+    return peak_rss
+
+
+def convert_json_to_marc21xml(metadata: dict) -> etree:
+    """Convert the MARC-in-JSON metadata of a record into a MARCXML record.
+
+    This is the inverse of ``convert_marc21xml_to_json`` of
+    invenio-records-marc21, the blank indicators stored as "_" become " ".
+    """
+
+    def qname(localname):
+        return f"{{{MARC21_NAMESPACE}}}{localname}"
+
+    record = etree.Element(qname("record"), nsmap={None: MARC21_NAMESPACE})
+    leader = etree.SubElement(record, qname("leader"))
+    leader.text = metadata.get("leader", "")
+
+    for tag, value in sorted(metadata.get("fields", {}).items()):
+        if isinstance(value, str):
+            controlfield = etree.SubElement(record, qname("controlfield"), tag=tag)
+            controlfield.text = value
+            continue
+
+        for field in value:
+            datafield = etree.SubElement(
+                record,
+                qname("datafield"),
+                tag=tag,
+                ind1=field.get("ind1", "_").replace("_", " "),
+                ind2=field.get("ind2", "_").replace("_", " "),
+            )
+            for code, subfield_values in field.get("subfields", {}).items():
+                for subfield_value in subfield_values:
+                    subfield = etree.SubElement(datafield, qname("subfield"), code=code)
+                    subfield.text = subfield_value
+
+    return record
+
+
+def get_marc21_records(identity: Identity, query: str = "") -> t.Iterator[etree]:
+    """Stream the records of the marc21 records service.
+
+    The records are fetched with scan/scroll pagination, so the number of
+    records does not influence the memory usage.
+    """
+    service = current_records_marc21.records_service
+    result = service.scan(identity=identity, params={"q": query})
+
+    for hit in result.hits:
+        yield convert_json_to_marc21xml(hit["metadata"])
+
+
+def write_marcxml_element(xml_file: etree.xmlfile, element: etree) -> None:
+    """Write the element within the opened collection.
+
+    Writing the element as a whole would repeat the namespace declaration on
+    every record, writing it element by element uses the one of collection.
+    """
+    with xml_file.element(element.tag, element.attrib):
+        if element.text:
+            xml_file.write(element.text)
+
+        for child in element:
+            # comments and processing instructions are not part of MARCXML
+            if isinstance(child.tag, str):
+                write_marcxml_element(xml_file, child)
+            if child.tail:
+                xml_file.write(child.tail)
+
+
+def write_marcxml_collection(records: t.Iterable[etree], file_: t.IO) -> int:
+    """Write the records incrementally as MARCXML collection into file_."""
+    number_of_records = 0
+
+    with etree.xmlfile(file_, encoding="utf-8") as xml_file:
+        xml_file.write_declaration()
+        with xml_file.element(
+            f"{{{MARC21_NAMESPACE}}}collection", nsmap={None: MARC21_NAMESPACE}
+        ):
+            for record in records:
+                write_marcxml_element(xml_file, record)
+                number_of_records += 1
+
+    return number_of_records
+
+
+def get_export_path(output: Path, shard: int, sharded: bool, gzip_: bool) -> Path:
+    """Get the path of the shard, e.g. export-00001.xml.gz."""
+    name = output.name[: -len(".gz")] if output.suffix == ".gz" else output.name
+
+    if sharded:
+        path = Path(name)
+        name = f"{path.stem}-{shard:05d}{path.suffix}"
+
+    if gzip_:
+        name = f"{name}.gz"
+
+    return output.with_name(name)
+
+
+def export_records(
+    records: t.Iterable[etree],
+    output: Path,
+    gzip_: bool = False,
+    shard_size: int = None,
+) -> t.Iterator[t.Tuple[Path, int]]:
+    """Export the records into one or, if shard_size is set, multiple files.
+
+    The output is gzipped if gzip_ is set or output ends with .gz. Yield the
+    path together with the number of records after each file is written.
+    """
+    gzip_ = gzip_ or output.suffix == ".gz"
+    opener = gzip.open if gzip_ else open
+    records = iter(records)
+
+    for shard in count(1):
+        first = next(records, None)
+        if first is None and shard > 1:
+            break
+
+        chunk = [] if first is None else [first]
+        if shard_size:
+            chunk = chain(chunk, islice(records, shard_size - 1))
+        else:
+            chunk = chain(chunk, records)
+
+        path = get_export_path(output, shard, bool(shard_size), gzip_)
+        with opener(path, mode="wb") as file_:
+            number_of_records = write_marcxml_collection(chunk, file_)
+
+        yield path, number_of_records
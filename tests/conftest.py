@@ -12,10 +12,12 @@ fixtures are available.
 """
 
 
+from unittest.mock import Mock
+
 import pytest
 from flask import Flask
 
-from invenio_alma import InvenioAlma
+from invenio_alma import InvenioAlma, cli
 
 
 @pytest.fixture(scope="module")
@@ -38,3 +40,12 @@ def create_app(instance_path):
         return app
 
     return factory
+
+
+@pytest.fixture()
+def handled(monkeypatch):
+    """Replace the import of a row and the release of memory by mocks."""
+    mocks = Mock()
+    monkeypatch.setattr(cli, "handle_row", mocks.handle_row)
+    monkeypatch.setattr(cli, "release_memory", mocks.release_memory)
+    return mocks
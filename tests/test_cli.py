@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Graz University of Technology.
+#
+# invenio-alma is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""CLI tests."""
+
+from unittest.mock import Mock
+
+import pytest
+from flask import Flask
+
+from invenio_alma import cli
+
+
+@pytest.mark.parametrize(
+    "cleanup_interval,expected_calls", [(2, 2), (3, 1), (1, 5), (0, 0)]
+)
+def test_handle_csv_releases_memory(handled, cleanup_interval, expected_calls):
+    """Test that the memory is released every cleanup_interval rows."""
+    user = object()
+    rows = [{"ac_number": f"AC{i}"} for i in range(5)]
+
+    cli.handle_csv(rows, "config", Mock(user=user), cleanup_interval)
+
+    assert handled.handle_row.call_count == 5
+    assert handled.release_memory.call_count == expected_calls
+    for call in handled.release_memory.call_args_list:
+        assert call.kwargs["keep"] == [user]
+
+
+def test_sru_report_memory(handled, monkeypatch, tmp_path):
+    """Test that --report-memory prints the peak rss."""
+    monkeypatch.setattr(cli, "get_identity_from_user_by_email", Mock())
+    monkeypatch.setattr(cli, "get_peak_rss", Mock(return_value=1234))
+    csv_file = tmp_path / "import.csv"
+    csv_file.write_text("ac_number,filename\nAC1,file.pdf\n", encoding="utf-8")
+    runner = Flask("testapp").test_cli_runner()
+
+    args = ["--search-key", "local_field_995", "--domain", "alma.example.org"]
+    args += ["--institution-code", "43ACC_TUG", "--csv-file", str(csv_file)]
+    result = runner.invoke(cli.sru, [*args, "--report-memory"])
+
+    assert result.exit_code == 0, result.output
+    assert handled.handle_row.call_count == 1
+    assert "peak rss: 1234 KiB" in result.output
+
+    result = runner.invoke(cli.sru, args)
+
+    assert "peak rss" not in result.output
+
+
+def test_export(monkeypatch, tmp_path):
+    """Test that the options reach export_records and each shard is printed."""
+    records = Mock()
+    written = [(tmp_path / "a-00001.xml.gz", 2), (tmp_path / "a-00002.xml.gz", 1)]
+    get_identity = Mock()
+    get_marc21_records = Mock(return_value=records)
+    export_records = Mock(return_value=iter(written))
+    monkeypatch.setattr(cli, "get_identity_from_user_by_email", get_identity)
+    monkeypatch.setattr(cli, "get_marc21_records", get_marc21_records)
+    monkeypatch.setattr(cli, "export_records", export_records)
+    runner = Flask("testapp").test_cli_runner()
+    output = tmp_path / "a.xml"
+
+    args = ["--output", str(output), "--gzip", "--shard-size", "2"]
+    result = runner.invoke(cli.export, [*args, "--query", "title:foo"])
+
+    assert result.exit_code == 0, result.output
+    get_marc21_records.assert_called_once_with(
+        get_identity.return_value, query="title:foo"
+    )
+    export_records.assert_called_once_with(records, output, gzip_=True, shard_size=2)
+    assert result.output.splitlines() == [
+        f"exported 2 records to {tmp_path / 'a-00001.xml.gz'}",
+        f"exported 1 records to {tmp_path / 'a-00002.xml.gz'}",
+    ]
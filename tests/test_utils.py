@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 Graz University of Technology.
+#
+# invenio-alma is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Utils tests."""
+
+import gzip
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+from lxml import etree
+
+from invenio_alma import utils
+from invenio_alma.utils import (
+    AlmaConfig,
+    SRURecordLookup,
+    convert_json_to_marc21xml,
+    export_records,
+    get_marc21_records,
+    get_peak_rss,
+    get_response_from_alma,
+    release_memory,
+)
+
+
+def test_sru_lookup_coalesces_concurrent_requests(monkeypatch):
+    """Test that concurrent lookups of the same key share one fetch."""
+    waiting = threading.Semaphore(0)
+
+    class CountingFuture(Future):
+        """Future which signals every caller waiting for the result."""
+
+        def result(self, timeout=None):
+            waiting.release()
+            return super().result(timeout)
+
+    monkeypatch.setattr(utils, "Future", CountingFuture)
+
+    # without LRU every lookup not coalesced with the in-flight one would fetch
+    lookup = SRURecordLookup(maxsize=0)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=5)
+        return etree.fromstring("<record><leader>abc</leader></record>")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(lookup.get, "AC1", fetch)]
+        assert started.wait(timeout=5)
+        futures += [executor.submit(lookup.get, "AC1", fetch) for _ in range(3)]
+
+        # wait until the followers wait for the result of the in-flight request
+        for _ in range(3):
+            assert waiting.acquire(timeout=5)
+
+        release.set()
+        records = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert all(etree.tostring(r) == etree.tostring(records[0]) for r in records)
+    assert len({id(record) for record in records}) == 4
+
+
+def test_get_response_from_alma_timeout(monkeypatch):
+    """Test that the request to alma can not hang forever."""
+    requests = Mock()
+    requests.get.return_value.text = "<searchRetrieveResponse/>"
+    monkeypatch.setattr(utils, "requests", requests)
+    alma_config = AlmaConfig("local_field_995", "alma.example.org", "43ACC_TUG")
+
+    get_response_from_alma(alma_config, "AC1", timeout=10)
+
+    assert requests.get.call_args.kwargs["timeout"] == 10
+
+
+def test_sru_lookup_lru():
+    """Test that recent results are remembered and old ones evicted."""
+    lookup = SRURecordLookup(maxsize=1)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return etree.Element("record")
+
+    lookup.get("AC1", fetch)
+    lookup.get("AC1", fetch)
+    assert len(calls) == 1
+
+    lookup.get("AC2", fetch)
+    lookup.get("AC1", fetch)
+    assert len(calls) == 3
+
+
+def test_sru_lookup_does_not_cache_errors():
+    """Test that a failed fetch is not remembered."""
+    lookup = SRURecordLookup()
+
+    def fail():
+        raise ConnectionError("alma not reachable")
+
+    with pytest.raises(ConnectionError):
+        lookup.get("AC1", fail)
+
+    assert lookup.get("AC1", lambda: etree.Element("record")) is not None
+
+
+def test_sru_lookup_does_not_cache_misses():
+    """Test that a lookup without a record is fetched again."""
+    lookup = SRURecordLookup()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+
+    assert lookup.get("AC1", fetch) is None
+    assert lookup.get("AC1", fetch) is None
+    assert len(calls) == 2
+
+
+def test_sru_lookup_releases_in_flight_on_base_exception():
+    """Test that an interrupted fetch does not stay in flight."""
+    lookup = SRURecordLookup()
+
+    def interrupt():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        lookup.get("AC1", interrupt)
+
+    assert not lookup._in_flight  # pylint: disable=protected-access
+
+
+MARC21_NAMESPACED_XML = (
+    '<marc:record xmlns:marc="http://www.loc.gov/MARC21/slim">'
+    "<!-- comment -->"
+    '<marc:controlfield tag="001">{}</marc:controlfield><?pi?>'
+    "</marc:record>"
+)
+
+
+def get_metadata(number):
+    """Get metadata as stored by the marc21 records service."""
+    return {
+        "leader": "00000nam a2200000zca4500",
+        "fields": {
+            "245": [
+                {"ind1": "1", "ind2": "_", "subfields": {"a": ["Title"], "b": ["x"]}}
+            ],
+            "001": str(number),
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "output,gzip_",
+    [("export.xml", True), ("export.xml.gz", True), ("export.xml.gz", False)],
+)
+def test_export_records_sharded_gzip(tmp_path, output, gzip_):
+    """Test that the records are split into gzipped MARCXML collections."""
+    records = (convert_json_to_marc21xml(get_metadata(i)) for i in range(5))
+
+    written = export_records(records, tmp_path / output, gzip_=gzip_, shard_size=2)
+
+    assert [(path.name, n) for path, n in written] == [
+        ("export-00001.xml.gz", 2),
+        ("export-00002.xml.gz", 2),
+        ("export-00003.xml.gz", 1),
+    ]
+
+    with gzip.open(tmp_path / "export-00001.xml.gz") as file_:
+        collection = etree.parse(file_).getroot()
+
+    assert collection.tag == "{http://www.loc.gov/MARC21/slim}collection"
+    assert len(collection) == 2
+
+
+def test_export_records_default_namespace(tmp_path):
+    """Test that the records are serialized without namespace prefixes."""
+    records = [convert_json_to_marc21xml(get_metadata(1))]
+
+    (path, _), *_ = export_records(records, tmp_path / "a.xml")
+
+    assert path.read_bytes() == (
+        b"<?xml version='1.0' encoding='utf-8'?>\n"
+        b'<collection xmlns="http://www.loc.gov/MARC21/slim">'
+        b"<record><leader>00000nam a2200000zca4500</leader>"
+        b'<controlfield tag="001">1</controlfield>'
+        b'<datafield tag="245" ind1="1" ind2=" ">'
+        b'<subfield code="a">Title</subfield><subfield code="b">x</subfield>'
+        b"</datafield></record>"
+        b"</collection>"
+    )
+
+
+def test_export_records_skips_comments(tmp_path):
+    """Test that comments and processing instructions are not exported."""
+    records = [etree.fromstring(MARC21_NAMESPACED_XML.format(i)) for i in range(2)]
+
+    (path, number_of_records), *_ = export_records(records, tmp_path / "a.xml")
+
+    assert number_of_records == 2
+    assert path.read_bytes().endswith(
+        b'<record><controlfield tag="001">0</controlfield></record>'
+        b'<record><controlfield tag="001">1</controlfield></record>'
+        b"</collection>"
+    )
+
+
+def test_get_marc21_records(monkeypatch):
+    """Test that the hits of the records service are streamed as records."""
+    hits = [
+        {"id": "abcde-fgh12", "metadata": get_metadata(1)},
+        {"id": "ijklm-nop34", "metadata": {"leader": "", "fields": {}}},
+    ]
+    service = Mock()
+    service.scan.return_value.hits = iter(hits)
+    monkeypatch.setattr(utils, "current_records_marc21", Mock(records_service=service))
+
+    records = list(get_marc21_records("identity", query="title:foo"))
+
+    service.scan.assert_called_once_with(identity="identity", params={"q": "title:foo"})
+    assert [r.tag for r in records] == ["{http://www.loc.gov/MARC21/slim}record"] * 2
+    assert [len(r) for r in records] == [3, 1]
+    assert records[0][1].text == "1"
+    assert records[0][2].get("ind2") == " "
+
+
+def test_export_records_without_records(tmp_path):
+    """Test that an empty collection is written if there are no records."""
+    written = list(export_records([], tmp_path / "export.xml"))
+
+    assert written == [(tmp_path / "export.xml", 0)]
+
+
+def test_get_peak_rss():
+    """Test that the peak rss is a positive number of KiB."""
+    peak_rss = get_peak_rss()
+
+    assert isinstance(peak_rss, int)
+    assert peak_rss > 0
+
+
+def test_release_memory_keeps_objects(monkeypatch):
+    """Test that all objects except those to keep are expunged."""
+    user, record = object(), object()
+    session = Mock(new=set(), dirty=set(), deleted=set())
+    session.__iter__ = Mock(return_value=iter([user, record]))
+    monkeypatch.setattr(utils, "db", Mock(session=session))
+
+    release_memory(keep=[user])
+
+    session.expunge.assert_called_once_with(record)
+
+
+def test_release_memory_keeps_pending_changes(monkeypatch):
+    """Test that a session with pending changes is left untouched."""
+    session = Mock(new=set(), dirty={object()}, deleted=set())
+    session.__iter__ = Mock(return_value=iter([object()]))
+    monkeypatch.setattr(utils, "db", Mock(session=session))
+
+    release_memory()
+
+    session.expunge.assert_not_called()